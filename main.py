@@ -1,4 +1,6 @@
 import asyncio
+import contextlib
+import functools
 import logging
 import sys
 
@@ -19,6 +21,33 @@ tracker: Tracker
 proces_navn = "Opgaveflytning mellem medarbejdere i Nexus"
 logger = logging.getLogger(proces_navn)
 
+# Antal samtidige kald mod Nexus pr. arbejdsemne
+maks_samtidige_kald = 10
+
+# Beregnes én gang, så datoen ikke skifter midt i en kørsel
+dags_dato = datetime.today().strftime('%d-%m-%Y')
+
+@functools.lru_cache(maxsize=512)
+def hent_medarbejder(initialer: str):
+    # Mange flytninger deler samme medarbejder, så opslag genbruges i hele kørslen
+    return nexus.organisationer.hent_medarbejder_ved_initialer(initialer)
+
+def byg_professional_assignee(medarbejder: dict) -> dict:
+    return {
+        "professionalId": medarbejder["id"],
+        "displayName": medarbejder["fullName"],
+        "displayNameWithUniqId": f"{medarbejder['fullName']} ({medarbejder['primaryIdentifier']})",
+        "active": medarbejder["active"]
+    }
+
+def afvis_proces(proces: dict, initialer: str):
+    # Finder første (og eneste) acitivity tilhøerende RPAIntegration
+    activity_id = next(activity["possibleActivitiesIdsToRejectTo"][0] for activity in proces["activities"] if activity["activityName"] == "RPAIntegration")
+    xflow_process_client.reject_process(proces["publicId"], activity_id, f"Medarbejder med initialer: {initialer} blev ikke fundet i Nexus")
+    logger.warning(
+            f"Anmodning med id: {proces['publicId']} blev afvist, da medarbejder med initialer: {initialer} ikke blev fundet i Nexus."
+        )
+
 async def populate_queue(workqueue: Workqueue):    
     xlow_søge_query = {
         "text": "OPGAVEFLYTNING MELLEM MEDARBEJDERE I NEXUS",
@@ -27,7 +56,7 @@ async def populate_queue(workqueue: Workqueue):
         ],
         "startIndex": 0,        
         "createdDateFrom": "01-01-1980",
-        "createdDateTo":  datetime.today().strftime('%d-%m-%Y'),
+        "createdDateTo":  dags_dato,
     }
 
     igangværende_processer = xflow_process_client.search_processes_by_current_activity(
@@ -35,81 +64,130 @@ async def populate_queue(workqueue: Workqueue):
         activity_name="RPAIntegration"
     )
 
+    behandlede_processer: set[str] = set()
+
     for proces in igangværende_processer:        
-        # TODO: Check if the process is already in the workqueue
+        # Køen tømmes før den dannes, så dubletter kan kun komme fra søgeresultatet
+        if proces["publicId"] in behandlede_processer:
+            continue
+
+        behandlede_processer.add(proces["publicId"])
         
         flyt_opgaver_fra_initialer: str = str(xflow_process_client.find_process_element_value(proces, "FraMedarbejder", "Tekst"))
-        flyt_opgaver_til_initialer: str = str(xflow_process_client.find_process_element_value(proces, "TilMedarbejder", "Tekst"))
+        # Tomt felt betyder, at opgaverne skal fjernes fra medarbejderen uden ny modtager
+        til_initialer_værdi = xflow_process_client.find_process_element_value(proces, "TilMedarbejder", "Tekst")
+        flyt_opgaver_til_initialer: str = "" if til_initialer_værdi is None else str(til_initialer_værdi).strip()
 
-        medarbejder_fra = nexus.organisationer.hent_medarbejder_ved_initialer(flyt_opgaver_fra_initialer)
+        medarbejder_fra = hent_medarbejder(flyt_opgaver_fra_initialer)
 
         if medarbejder_fra is None: 
-            # Finder første (og eneste) acitivity tilhøerende RPAIntegration
-            activity_id = next(activity["possibleActivitiesIdsToRejectTo"][0] for activity in proces["activities"] if activity["activityName"] == "RPAIntegration")
-            xflow_process_client.reject_process(proces["publicId"], activity_id, f"Medarbejder med initialer: {medarbejder_fra} blev ikke fundet i Nexus")
-            logging.warning(
-                    f"Anmodning med id: {proces['publicId']} blev afvist, da medarbejder med initialer: {flyt_opgaver_fra_initialer} ikke blev fundet i Nexus."
-                )
-            break
+            afvis_proces(proces, flyt_opgaver_fra_initialer)
+            continue
+
+        til_medarbejder = None
+
+        if not flyt_opgaver_til_initialer == "":
+            medarbejder_til = hent_medarbejder(flyt_opgaver_til_initialer)
+
+            if medarbejder_til is None:
+                afvis_proces(proces, flyt_opgaver_til_initialer)
+                continue
+
+            til_medarbejder = byg_professional_assignee(medarbejder_til)
             
         kø_data = {
             "from_initials": flyt_opgaver_fra_initialer,
             "to_initials": flyt_opgaver_til_initialer,
+            "to_professional": til_medarbejder,
             "xflow_process_id": proces["publicId"],
         }
 
         workqueue.add_item(kø_data, f"{flyt_opgaver_fra_initialer} - {flyt_opgaver_til_initialer}")        
 
+@contextlib.asynccontextmanager
+async def opgavegruppe():
+    # TaskGroup annullerer og afventer resterende opgaver, hvis én fejler, så intet kører videre efter arbejdsemnet er fejlet.
+    # Fejlen pakkes ud af ExceptionGroup, så arbejdsemnet får den oprindelige fejl og fejlbesked
+    try:
+        async with asyncio.TaskGroup() as tg:
+            yield tg
+    except ExceptionGroup as eg:
+        raise eg.exceptions[0]
+
+async def hent_borger(cpr: str, semafor: asyncio.Semaphore):
+    async with semafor:
+        return await asyncio.to_thread(nexus.borgere.hent_borger, cpr)
+
+async def flyt_opgave(opgave: dict, borger: dict | None, til_medarbejder: dict | None, semafor: asyncio.Semaphore):
+    # Nexus-klienten er synkron, så selve kaldene afvikles i tråde, mens rapportering og tracking sker i event loop'et
+    async with semafor:
+        nexus_opgave = None
+
+        try:
+            if borger is None:
+                raise WorkItemError(f"Kunne ikke finde borger med CPR: {opgave['cpr']}")
+
+            nexus_opgave = await asyncio.to_thread(nexus.opgaver.hent_opgave_for_borger, borger, opgave["id"])
+
+            if nexus_opgave is None:
+                report(
+                    report_id="opgaveflytning_mellem_medarbejdere_i_nexus",
+                    group="Fejl",
+                    json={
+                        "CPR": opgave["cpr"],
+                        "Fejl": "Kunne ikke finde opgave i Nexus",
+                    }
+                )
+                return
+
+            nexus_opgave["professionalAssignee"] = til_medarbejder
+            await asyncio.to_thread(nexus.opgaver.rediger_opgave, nexus_opgave)
+
+            tracker.track_task(proces_navn)
+        except WorkItemError:
+            report(
+                report_id="opgaveflytning_mellem_medarbejdere_i_nexus",
+                group="Fejl",
+                json={
+                    "CPR": opgave["cpr"],
+                    "Fejl": f"Kunne ikke redigere opgave med navn: {nexus_opgave['title'] if nexus_opgave and 'title' in nexus_opgave else 'Ukendt'} i Nexus",
+                }
+            )
+
 async def process_workqueue(workqueue: Workqueue):
     for item in workqueue:
         with item:
             data = item.data            
             opgaver = nexus_database_client.get_tasks_by_professional(data["from_initials"])
+            # Databasens view kan returnere samme opgave flere gange
+            opgaver = list({(opgave["cpr"], opgave["id"]): opgave for opgave in opgaver}.values())
 
-            til_medarbejder = None
+            # Modtagende medarbejder er slået op i Nexus, da køen blev dannet. Ældre arbejdsemner har ikke opslaget med
+            if "to_professional" in data:
+                til_medarbejder = data["to_professional"]
+            else:
+                til_medarbejder = None
 
-            if data["to_initials"] is not None and not data["to_initials"].strip() == "":
-                medarbejder = nexus.organisationer.hent_medarbejder_ved_initialer(data["to_initials"])
-                til_medarbejder = {
-                    "professionalId": medarbejder["id"],
-                    "displayName": medarbejder["fullName"],
-                    "displayNameWithUniqId": f"{medarbejder['fullName']} ({medarbejder['primaryIdentifier']})",
-                    "active": medarbejder["active"]
-                }
+                if data["to_initials"] is not None and not data["to_initials"].strip() == "":
+                    medarbejder = hent_medarbejder(data["to_initials"])
+
+                    if medarbejder is None:
+                        raise WorkItemError(f"Kunne ikke finde medarbejder med initialer: {data['to_initials']}")
+
+                    til_medarbejder = byg_professional_assignee(medarbejder)
+
+            semafor = asyncio.Semaphore(maks_samtidige_kald)
+
+            # En borger kan have flere opgaver, så hver borger hentes kun én gang
+            cpr_numre = {opgave["cpr"] for opgave in opgaver}
+            async with opgavegruppe() as tg:
+                borger_opslag = {cpr: tg.create_task(hent_borger(cpr, semafor)) for cpr in cpr_numre}
+            borger_efter_cpr = {cpr: opslag.result() for cpr, opslag in borger_opslag.items()}
+
+            async with opgavegruppe() as tg:
+                for opgave in opgaver:
+                    tg.create_task(flyt_opgave(opgave, borger_efter_cpr[opgave["cpr"]], til_medarbejder, semafor))
 
-            for opgave in opgaver:                
-                try:
-                    borger = nexus.borgere.hent_borger(opgave["cpr"])
-
-                    if borger is None:
-                        raise WorkItemError(f"Kunne ikke finde borger med CPR: {opgave['cpr']}")
-
-                    nexus_opgave = nexus.opgaver.hent_opgave_for_borger(borger, opgave["id"])
-
-                    if nexus_opgave is None:
-                        report(
-                            report_id="opgaveflytning_mellem_medarbejdere_i_nexus",
-                            group="Fejl",
-                            json={
-                                "CPR": opgave["cpr"],
-                                "Fejl": "Kunne ikke finde opgave i Nexus",
-                            }
-                        )                        
-                        continue
-
-                    nexus_opgave["professionalAssignee"] = til_medarbejder
-                    nexus.opgaver.rediger_opgave(nexus_opgave)
-                    
-                    tracker.track_task(proces_navn)
-                except WorkItemError:
-                    report(
-                            report_id="opgaveflytning_mellem_medarbejdere_i_nexus",
-                            group="Fejl",
-                            json={
-                                "CPR": opgave["cpr"],
-                                "Fejl": f"Kunne ikke redigere opgave med navn: {nexus_opgave['title'] if nexus_opgave and 'title' in nexus_opgave else 'Ukendt'} i Nexus",
-                            }
-                    )
             blanket_data = {
                 "formValues": [
                     {
@@ -120,7 +198,7 @@ async def process_workqueue(workqueue: Workqueue):
                     {
                         "elementIdentifier": "RPABehandletDato",
                         "valueIdentifier": "Dato",
-                        "value": datetime.today().strftime('%d-%m-%Y')      
+                        "value": dags_dato      
                     }
                 ]        
             }
@@ -166,8 +244,6 @@ if __name__ == "__main__":
         password=tracking_credential.password
     )
 
-    logger = logging.getLogger(__name__)
-
     # Queue management
     if "--queue" in sys.argv:
         workqueue.clear_workqueue("new")